@@ -1,6 +1,5 @@
 
 import numpy as np
-from deap import benchmarks
 
 import sys
 
@@ -43,16 +42,14 @@ class shekel(object):
         self._z, self.meanz, self.stdz, self.normalized_z = None, None, None, None # To instantiate attr after assigning in __init__
         self.create_field()  # This method creates the normalized_z values
 
-    def shekel_arg0(self, sol):
-
-        return np.nan if self.grid[sol[1]][sol[0]] == 1 else \
-            benchmarks.shekel(sol[:2]/np.array(self.grid.shape)*10, self.A, self.C)[0]
-
     def create_field(self):
 
         """ Creation of the normalized z field """
-        self._z = np.fromiter(map(self.shekel_arg0, zip(self._x.flat, self._y.flat)), dtype=np.float32,
-                              count=self._x.shape[0] * self._x.shape[1]).reshape(self._x.shape)
+        # Evaluate the shekel function sum_i 1 / (c_i + ||x - a_i||^2) in every cell at once
+        points = np.stack((self._x / self.grid.shape[0] * 10, self._y / self.grid.shape[1] * 10), axis=-1)
+        squared_distances = np.sum((points[:, :, np.newaxis, :] - self.A) ** 2, axis=-1)
+        self._z = np.sum(1.0 / (self.C[:, 0] + squared_distances), axis=-1).astype(np.float32)
+        self._z[self.grid == 1] = np.nan
 
         self.meanz = np.nanmean(self._z)
         self.stdz = np.nanstd(self._z)
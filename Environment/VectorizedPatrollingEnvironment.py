@@ -0,0 +1,187 @@
+import numpy as np
+import numba
+
+
+@numba.njit(cache=True, fastmath=True)
+def rollout(actions, initial_positions, navigation_map, ground_truth, directions, influence_offsets, model_offsets,
+            number_of_minimoves, forgetting_factor, max_distance):
+	""" Simulate complete episodes of every world (actions is an array of worlds x T x agents) and return the
+	accumulated W and I of every world. The worlds run sequentially, as the GA already runs one process per core """
+
+	B, T, N = actions.shape
+	H, L = navigation_map.shape
+
+	W = np.zeros(B)
+	I = np.zeros(B)
+
+	for b in range(B):
+
+		# State of the world #
+		positions = initial_positions.copy()
+		mask_positions = initial_positions.copy()
+		distance = np.zeros(N)
+		active = np.ones(N, dtype=np.bool_)
+		last_waypoints = np.zeros((N, number_of_minimoves, 2))
+		last_waypoints_valid = np.zeros((N, number_of_minimoves), dtype=np.bool_)
+		idleness = np.ones((H, L))
+		model_map = np.zeros((H, L), dtype=np.float32)
+		sampled = np.zeros((H, L), dtype=np.bool_)
+
+		for t in range(T):
+
+			# Move the active vehicles #
+			for n in range(N):
+
+				if distance[n] > max_distance:
+					active[n] = False
+
+				if not active[n]:
+					continue
+
+				action = actions[b, t, n] % 8
+				original_y, original_x = positions[n, 0], positions[n, 1]
+				last_waypoints_valid[n, :] = False
+
+				for minimove in range(1, number_of_minimoves + 1):
+
+					target_y = int(original_y + minimove * directions[action, 0])
+					target_x = int(original_x + minimove * directions[action, 1])
+					last_waypoints_valid[n, minimove - 1] = True
+
+					if target_y < 0 or target_y >= H or target_x < 0 or target_x >= L or navigation_map[target_y, target_x] == 0:
+						# Stop before the obstacle. The influence area is not updated #
+						mask_positions[n, 0], mask_positions[n, 1] = positions[n, 0], positions[n, 1]
+						positions[n, 0] = original_y + (minimove - 1 / number_of_minimoves) * directions[action, 0]
+						positions[n, 1] = original_x + (minimove - 1 / number_of_minimoves) * directions[action, 1]
+						last_waypoints[n, minimove - 1, 0], last_waypoints[n, minimove - 1, 1] = positions[n, 0], positions[n, 1]
+						break
+
+					distance[n] += np.sqrt((target_y - positions[n, 0]) ** 2 + (target_x - positions[n, 1]) ** 2)
+					positions[n, 0], positions[n, 1] = target_y, target_x
+					mask_positions[n, 0], mask_positions[n, 1] = target_y, target_x
+					last_waypoints[n, minimove - 1, 0], last_waypoints[n, minimove - 1, 1] = target_y, target_x
+
+			# Every cell in an influence area ends with 0 idleness, so its change is the previous idleness #
+			redundancy = 0
+			W_t = 0.0
+			for n in range(N):
+				if active[n]:
+					for k in range(influence_offsets.shape[0]):
+						y = int(mask_positions[n, 0]) + influence_offsets[k, 0]
+						x = int(mask_positions[n, 1]) + influence_offsets[k, 1]
+						if 0 <= y < H and 0 <= x < L:
+							redundancy += 1
+							W_t += idleness[y, x]
+
+			# Update the idleness #
+			for y in range(H):
+				for x in range(L):
+					idleness[y, x] = min(max(idleness[y, x] + forgetting_factor, 0.0), 1.0) * navigation_map[y, x]
+
+			for n in range(N):
+				if active[n]:
+					for k in range(influence_offsets.shape[0]):
+						y = int(mask_positions[n, 0]) + influence_offsets[k, 0]
+						x = int(mask_positions[n, 1]) + influence_offsets[k, 1]
+						if 0 <= y < H and 0 <= x < L:
+							idleness[y, x] = 0.0
+
+			# Update the miopic model. The sampled positions keep their true values #
+			for n in range(N):
+				for m in range(number_of_minimoves):
+					if last_waypoints_valid[n, m]:
+						y = min(max(int(last_waypoints[n, m, 0]), 0), H - 1)
+						x = min(max(int(last_waypoints[n, m, 1]), 0), L - 1)
+						sampled[y, x] = True
+						model_map[y, x] = ground_truth[y, x]
+
+			for n in range(N):
+				for m in range(number_of_minimoves):
+					if last_waypoints_valid[n, m]:
+						center_y = min(max(int(last_waypoints[n, m, 0]), 0), H - 1)
+						center_x = min(max(int(last_waypoints[n, m, 1]), 0), L - 1)
+						for k in range(model_offsets.shape[0]):
+							y = center_y + model_offsets[k, 0]
+							x = center_x + model_offsets[k, 1]
+							if 0 <= y < H and 0 <= x < L and navigation_map[y, x] == 1 and not sampled[y, x]:
+								model_map[y, x] = ground_truth[center_y, center_x]
+
+			I_t = 0.0
+			for n in range(N):
+				if active[n]:
+					for k in range(influence_offsets.shape[0]):
+						y = int(mask_positions[n, 0]) + influence_offsets[k, 0]
+						x = int(mask_positions[n, 1]) + influence_offsets[k, 1]
+						if 0 <= y < H and 0 <= x < L:
+							I_t += model_map[y, x]
+
+			if redundancy > 0:
+				W[b] += W_t / redundancy
+				I[b] += I_t / redundancy
+
+	return W, I
+
+
+class VectorizedPatrollingEnv:
+	""" Batched version of DiscreteModelBasedPatrolling that simulates independent copies of the same scenario, one
+	per sequence of actions. It reproduces the discrete movements of the fleet, the idleness map and the miopic model
+	with a static ground truth, and returns, for every world, the W (changes in idleness) and I (information gain)
+	terms of the weighted idleness reward summed over the active agents and the episode.
+	"""
+
+	def __init__(self,
+	             navigation_map: np.ndarray,
+	             initial_positions: np.ndarray,
+	             ground_truth: np.ndarray,
+	             movement_length: int,
+	             influence_radius: float,
+	             forgetting_factor: float,
+	             max_distance: float):
+
+		self.navigation_map = navigation_map
+		self.initial_positions = np.atleast_2d(initial_positions)
+		self.n_agents = len(self.initial_positions)
+		self.ground_truth = ground_truth
+		self.movement_length = movement_length
+		self.number_of_minimoves = np.round(movement_length).astype(int)
+		self.influence_radius = influence_radius
+		self.forgetting_factor = forgetting_factor
+		self.max_distance = max_distance
+
+		# Unitary (integer) direction of every discrete action, as in Vehicle.move #
+		angles = np.arange(8) * 2.0 * np.pi / 8.0
+		self.directions = np.round(np.column_stack((np.cos(angles), np.sin(angles)))).astype(int)
+
+		# Offsets of the cells inside the influence area of a vehicle (Vehicle._influence_mask) #
+		self.influence_offsets = self._disk_offsets(lambda distance: distance <= self.influence_radius)
+		# Offsets of the cells updated by a sample in the miopic model (MiopicModel.update) #
+		self.model_offsets = self._disk_offsets(lambda distance: distance.astype(int) <= self.influence_radius)
+
+	@classmethod
+	def from_env(cls, env):
+		""" Create a vectorized copy of a DiscreteModelBasedPatrolling environment with its current ground truth """
+
+		return cls(navigation_map=env.navigation_map,
+		           initial_positions=env.initial_positions,
+		           ground_truth=env.ground_truth.read().copy(),
+		           movement_length=env.movement_length,
+		           influence_radius=env.influence_radius,
+		           forgetting_factor=env.forgetting_factor,
+		           max_distance=env.max_distance)
+
+	def _disk_offsets(self, condition):
+		""" Return the (dy, dx) offsets around a cell whose euclidean distance satisfies the condition """
+
+		r = int(np.ceil(self.influence_radius)) + 1
+		dy, dx = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1), indexing='ij')
+		inside = condition(np.sqrt(dy ** 2 + dx ** 2))
+
+		return np.column_stack((dy[inside], dx[inside]))
+
+	def rollout(self, actions: np.ndarray):
+		""" Simulate complete episodes of all the worlds with the actions (array of n_worlds x T x n_agents) using the
+		compiled rollout and return the accumulated W and I of every world """
+
+		return rollout(np.ascontiguousarray(actions), self.initial_positions.astype(float), self.navigation_map,
+		               self.ground_truth, self.directions, self.influence_offsets, self.model_offsets,
+		               self.number_of_minimoves, float(self.forgetting_factor), float(self.max_distance))
@@ -22,6 +22,8 @@ argparser.add_argument('--lr', type=float, default=1e-3)
 argparser.add_argument('--weight_decay', type=float, default=0)
 argparser.add_argument('--device', type=str, default='cuda:0', choices=['cuda:0', 'cuda:1', 'cpu']) 
 argparser.add_argument('--scale', type=int, default=1) 
+argparser.add_argument('--amp', action='store_true', help='Use FP16 automatic mixed precision (CUDA only)')
+argparser.add_argument('--norm_type', type=str, default='bn', choices=['bn', 'gn'], help='BatchNorm or GroupNorm')
 
 args = argparser.parse_args()
 
@@ -56,10 +58,13 @@ device_str = args.device
 device = th.device(device_str)
 
 # Import the model
-model = UNet(n_channels_in=2, n_channels_out=1, bilinear=False, scale=2).to(device)
+model = UNet(n_channels_in=2, n_channels_out=1, bilinear=False, scale=2, norm_type=args.norm_type).to(device)
 
 # Define the optimizer
 optimizer = th.optim.Adam(model.parameters(), lr = args.lr)
+# Mixed precision is only used in the GPU. The scaler is a no-op when disabled
+use_amp = args.amp and device.type == 'cuda'
+scaler = th.cuda.amp.GradScaler(enabled=use_amp)
 #NOTE: The loss function is defined in the model
 
 # Define the number of epochs
@@ -73,6 +78,8 @@ os.system('rm -rf ' + dir_path)
 writer = tb.SummaryWriter(log_dir=dir_path, comment='Unet_training_{}'.format(benchmark))
 
 mask_tensor = th.Tensor(mask).float().to(device)
+# The maps have a fixed shape, so let cuDNN benchmark and keep the fastest algorithms
+th.backends.cudnn.benchmark = True
 
 
 for epoch in tqdm(range(N_epochs), desc="Epochs: "):
@@ -92,7 +99,8 @@ for epoch in tqdm(range(N_epochs), desc="Epochs: "):
 			batch_gt = batch_gt.unsqueeze(1)
 
 		# Forward pass
-		output = model(batch)
+		with th.autocast(device_type=device.type, dtype=th.float16, enabled=use_amp):
+			output = model(batch)
 
 		# Compute the loss
 		loss = model.compute_loss(x_predicted=output, x_gt=batch_gt, mask=mask_tensor)
@@ -103,9 +111,10 @@ for epoch in tqdm(range(N_epochs), desc="Epochs: "):
 		# Reset the gradients
 		optimizer.zero_grad()
 		# Backward pass
-		loss.backward()
+		scaler.scale(loss).backward()
 		# Apply the gradients
-		optimizer.step()
+		scaler.step(optimizer)
+		scaler.update()
 
 	# Test the model
 	model.eval()
@@ -126,7 +135,8 @@ for epoch in tqdm(range(N_epochs), desc="Epochs: "):
 			batch_gt = batch_gt.unsqueeze(1)
 
 			# Forward pass
-			output = model(batch)
+			with th.autocast(device_type=device.type, dtype=th.float16, enabled=use_amp):
+				output = model(batch)
 			# Compute the loss
 			test_loss = model.compute_loss(x_predicted=output, x_gt=batch_gt, mask=mask_tensor)
 
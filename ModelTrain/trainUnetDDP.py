@@ -0,0 +1,200 @@
+import sys
+sys.path.append('.')
+from ModelTrain.dataset import StaticDataset
+from Models.unet import UNet
+import torch as th
+import torch.distributed as dist
+import numpy as np
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+import torch.utils.tensorboard as tb
+from tqdm.auto import tqdm
+import os
+import time
+import argparse
+from contextlib import nullcontext
+
+# Multi-GPU version of trainUnet.py. Launch it with torchrun:
+# torchrun --nproc_per_node=NGPU ModelTrain/trainUnetDDP.py --benchmark shekel
+
+# Define the parameters of the environment
+argparser = argparse.ArgumentParser()
+
+argparser.add_argument('--benchmark', type=str, default='algae_bloom', choices=['algae_bloom', 'shekel'])
+argparser.add_argument('--epochs', type=int, default=50)
+argparser.add_argument('--batch_size', type=int, default=64, help='Batch size per process')
+argparser.add_argument('--lr', type=float, default=1e-3)
+argparser.add_argument('--weight_decay', type=float, default=0)
+argparser.add_argument('--scale', type=int, default=2, help='Channel reduction of the UNet. UnetDeepModel loads scale 2')
+argparser.add_argument('--amp', action='store_true', help='Use FP16 automatic mixed precision')
+argparser.add_argument('--norm_type', type=str, default='bn', choices=['bn', 'gn'], help='BatchNorm or GroupNorm')
+argparser.add_argument('--accumulation_steps', type=int, default=1, help='Micro-batches per optimizer step')
+
+args = argparser.parse_args()
+
+# Initialize the process group. torchrun sets the rank and world size in the environment
+dist.init_process_group(backend='nccl')
+local_rank = int(os.environ['LOCAL_RANK'])
+rank = dist.get_rank()
+th.cuda.set_device(local_rank)
+device = th.device('cuda', local_rank)
+
+benchmark = args.benchmark
+train_traj_file_name = 'ModelTrain/Data/trajectories_' + benchmark + '_train.npy'
+train_gt_file_name = 'ModelTrain/Data/gts_' + benchmark + '_train.npy'
+test_traj_file_name = 'ModelTrain/Data/trajectories_' + benchmark + '_test.npy'
+test_gt_file_name = 'ModelTrain/Data/gts_' + benchmark + '_test.npy'
+
+# Create the dataset
+dataset = StaticDataset(path_trajectories = train_traj_file_name,
+						path_gts = train_gt_file_name,
+						transform=None)
+
+dataset_test = StaticDataset(path_trajectories = test_traj_file_name,
+						path_gts = test_gt_file_name,
+						transform=None)
+
+
+mask = np.genfromtxt('Environment/Maps/map.txt', delimiter=' ')
+
+if rank == 0:
+	print("Shape of the dataset: ", dataset.trajectories.shape)
+
+# Create the dataloader. Every process reads a different partition of the dataset
+sampler = DistributedSampler(dataset, shuffle = True)
+sampler_test = DistributedSampler(dataset_test, shuffle = False)
+dataloader = DataLoader(dataset, batch_size = args.batch_size, sampler = sampler, num_workers = 0)
+dataloader_test = DataLoader(dataset_test, batch_size = args.batch_size, sampler = sampler_test, num_workers = 0)
+
+# Training Loop #
+
+# Import the model. The BatchNorm statistics are synchronized across the replicas
+model = UNet(n_channels_in=2, n_channels_out=1, bilinear=False, scale=args.scale, norm_type=args.norm_type)
+model = th.nn.SyncBatchNorm.convert_sync_batchnorm(model).to(device)
+model = DistributedDataParallel(model, device_ids=[local_rank])
+
+# Define the optimizer
+optimizer = th.optim.Adam(model.parameters(), lr = args.lr, weight_decay = args.weight_decay)
+scaler = th.cuda.amp.GradScaler(enabled=args.amp)
+#NOTE: The loss function is defined in the model
+
+# Define the number of epochs
+N_epochs = args.epochs
+
+# Start the training loop
+
+# Only the first process logs and saves the model
+dir_path = 'runs/TrainingUnet/Unet_{}_{}'.format(benchmark, time.strftime("%Y%m%d-%H%M%S"))
+if rank == 0:
+	os.system('rm -rf ' + dir_path)
+	writer = tb.SummaryWriter(log_dir=dir_path, comment='Unet_training_{}'.format(benchmark))
+
+mask_tensor = th.Tensor(mask).float().to(device)
+# The maps have a fixed shape, so let cuDNN benchmark and keep the fastest algorithms
+th.backends.cudnn.benchmark = True
+
+
+for epoch in tqdm(range(N_epochs), desc="Epochs: ", disable=rank != 0):
+
+	running_loss = []
+	model.train()
+	# Reshuffle the partitions every epoch
+	sampler.set_epoch(epoch)
+
+	# Reset the gradients
+	optimizer.zero_grad()
+
+	for i, data in tqdm(enumerate(dataloader), desc="Batches: ", total=len(dataloader), disable=rank != 0):
+
+		# Get the batch
+		batch, batch_gt = data
+
+		# Transform the batch to a float Tensor for the model
+		with th.no_grad():
+			batch = th.Tensor(batch).float().to(device)
+			batch_gt = th.Tensor(batch_gt).float().to(device)
+			batch_gt = batch_gt.unsqueeze(1)
+
+		# Forward pass
+		with th.autocast(device_type='cuda', dtype=th.float16, enabled=args.amp):
+			output = model(batch)
+
+		# Compute the loss
+		loss = model.module.compute_loss(x_predicted=output, x_gt=batch_gt, mask=mask_tensor)
+
+		# Add the loss to the running loss
+		running_loss.append(loss.item())
+
+		# Only the last micro-batch of the accumulation all-reduces the gradients
+		optimizer_step = (i + 1) % args.accumulation_steps == 0 or i + 1 == len(dataloader)
+
+		# Number of micro-batches of the current accumulation group. The last group is shorter when the number of
+		# batches is not a multiple of the accumulation steps
+		group_start = i - i % args.accumulation_steps
+		group_size = min(args.accumulation_steps, len(dataloader) - group_start)
+
+		# Backward pass. The accumulated gradients are all-reduced between the processes in the optimizer step
+		with nullcontext() if optimizer_step else model.no_sync():
+			scaler.scale(loss / group_size).backward()
+
+		if optimizer_step:
+			# Apply the gradients
+			scaler.step(optimizer)
+			scaler.update()
+			# Reset the gradients
+			optimizer.zero_grad()
+
+	# Test the model
+	model.eval()
+
+	with th.no_grad():
+
+		running_test_loss = []
+
+		# Get the batch
+
+		for i, data_test in enumerate(dataloader_test):
+
+			# Get the batch
+			batch, batch_gt = data_test
+			# Transform the batch to a float Tensor for the model
+			batch = th.Tensor(batch).float().to(device)
+			batch_gt = th.Tensor(batch_gt).float().to(device)
+			batch_gt = batch_gt.unsqueeze(1)
+
+			# Forward pass
+			with th.autocast(device_type='cuda', dtype=th.float16, enabled=args.amp):
+				output = model(batch)
+			# Compute the loss
+			test_loss = model.module.compute_loss(x_predicted=output, x_gt=batch_gt, mask=mask_tensor)
+
+			# Add the loss to the running loss
+			running_test_loss.append(test_loss.item())
+
+	# Average the losses of all the processes
+	losses = th.tensor([np.mean(running_loss), np.mean(running_test_loss)], device=device)
+	dist.all_reduce(losses)
+	train_loss, mean_test_loss = (losses / dist.get_world_size()).tolist()
+
+	if rank == 0:
+
+		# Save the model if the loss is lower than the previous one
+		if epoch == 0:
+			min_loss = mean_test_loss
+		elif mean_test_loss < min_loss:
+			th.save(model.module.state_dict(), dir_path + '/Unet_{}_test.pth'.format(benchmark))
+			min_loss = mean_test_loss
+		else:
+			th.save(model.module.state_dict(), dir_path + '/Unet_{}_train.pth'.format(benchmark))
+
+		# Add the test loss to the tb writer
+		writer.add_scalar('Test/Loss', mean_test_loss, epoch)
+
+		# Add the loss to the tb writer
+		writer.add_scalar('Train/Loss', train_loss, epoch)
+
+		# Print the loss
+		print("\nEpoch: {}/{} Train Loss: {:.3f} Test Loss: {:.3f}\n".format(epoch, N_epochs, train_loss, mean_test_loss))
+
+dist.destroy_process_group()
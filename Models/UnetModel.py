@@ -11,27 +11,123 @@ benchmark_2_vae_path = {'algae_bloom': r'runs/optuna/algae_bloom/VAEUnet_algae_b
                         'shekel':      r'runs/optuna/shekel/VAEUnet_shekel_test_trial_num_18.pth'}
 
 
+class UnetTRTEngine:
+	""" Thin wrapper around a TensorRT engine built with UNet.export_trt. It is called as the torch model """
+
+	def __init__(self, engine_path: str, device: str = 'cuda:0'):
+
+		import tensorrt as trt
+
+		self.device = th.device(device)
+		self.logger = trt.Logger(trt.Logger.WARNING)
+
+		# Deserialize the engine
+		with open(engine_path, 'rb') as engine_file:
+			self.engine = trt.Runtime(self.logger).deserialize_cuda_engine(engine_file.read())
+
+		self.context = self.engine.create_execution_context()
+
+	def __call__(self, x: th.Tensor):
+
+		# The engine expects a dense NCHW FP32 input
+		x = x.to(self.device).float().contiguous()
+		self.context.set_input_shape('x', tuple(x.shape))
+		y = th.empty(tuple(self.context.get_tensor_shape('y')), dtype=th.float32, device=self.device)
+
+		self.context.set_tensor_address('x', x.data_ptr())
+		self.context.set_tensor_address('y', y.data_ptr())
+		# Enqueue in the current torch stream so the following torch ops are ordered after the engine
+		self.context.execute_async_v3(th.cuda.current_stream(self.device).cuda_stream)
+
+		return y
+
+
 class UnetDeepModel:
 
 	def __init__(self, navigation_map: np.ndarray,
-	             model_path: str,
+	             model_path: str = None,
 	             device: str = 'cuda:0',
 	             resolution=1,
-	             influence_radius=2, dt=0.7):
+	             influence_radius=2, dt=0.7,
+	             engine_path: str = None,
+	             compile_model: bool = False,
+	             norm_type: str = None,
+	             use_cuda_graph: bool = False,
+	             cudnn_benchmark: bool = False):
+
+		# The TensorRT engine already contains the weights and the normalization layers of the exported model #
+		if engine_path is not None:
+			if model_path is not None or norm_type is not None or compile_model:
+				raise ValueError('model_path, norm_type and compile_model cannot be used with engine_path')
+		elif model_path is None:
+			raise ValueError('Either model_path or engine_path must be given')
 		
 		self.navigation_map = navigation_map
 		self.device = th.device('cuda:0' if th.cuda.is_available() else 'cpu')
+		# The input shape is always the same, so cuDNN can benchmark and keep the fastest algorithms. It is a
+		# process-wide setting, so it is only changed on request
+		if cudnn_benchmark:
+			th.backends.cudnn.benchmark = True
 
 		# Create the miopic predictor
 		self.pre_model = MiopicModel(navigation_map, influence_radius, resolution, dt)
-		# Create the model
-		self.model = UNet(n_channels_in=2, n_channels_out=1, bilinear=False, scale=2).to(device)
-		# Import the model
-		self.model.load_state_dict(th.load(model_path))
-		self.model.eval()
+
+		if engine_path is not None:
+			# Use the TensorRT engine in place of the torch model
+			self.model = UnetTRTEngine(engine_path, device=device)
+		else:
+			# Create the model
+			self.model = UNet(n_channels_in=2, n_channels_out=1, bilinear=False, scale=2,
+			                  norm_type='bn' if norm_type is None else norm_type).to(device)
+			# Import the model
+			self.model.load_state_dict(th.load(model_path))
+			# Fold the BatchNorms into the convolutions. This also sets the eval mode
+			self.model.fuse()
+
+			if compile_model:
+				# The navigation map shape never changes, so compile with static shapes and let inductor autotune and
+				# fuse the bias and the LeakyReLU into the convolution kernels. With use_cuda_graph the graph is captured
+				# below, so inductor must not record its own
+				mode = 'max-autotune-no-cudagraphs' if use_cuda_graph else 'max-autotune'
+				self.model = th.compile(self.model, dynamic=False, mode=mode, backend='inductor')
+				# Warmup with the true input shape to trigger the compilation and the autotuning
+				with th.no_grad(), th.autocast(device_type=self.device.type, dtype=th.float16, enabled=self.device.type == 'cuda'):
+					self.model(th.zeros((1, 2, *self.navigation_map.shape), device=self.device))
+
+		# CUDA graph of the forward. Only for the torch model, the TensorRT engine has its own launch path #
+		self.cuda_graph = None
+		if use_cuda_graph and engine_path is None and self.device.type == 'cuda':
+			self.capture_cuda_graph()
 
 		self.model_map = np.zeros_like(self.navigation_map)
 
+	def capture_cuda_graph(self):
+		""" Record the forward of the model in a CUDA graph. The graph reads static_input and writes static_output, so
+		every fast_forward replays the whole kernel sequence with a single launch """
+
+		self.static_input = th.zeros((1, 2, *self.navigation_map.shape), device=self.device)
+
+		# Warmup in a side stream before the capture, so cuDNN selects the algorithms and the buffers are allocated #
+		stream = th.cuda.Stream(self.device)
+		stream.wait_stream(th.cuda.current_stream(self.device))
+		with th.cuda.stream(stream), th.no_grad(), th.autocast(device_type='cuda', dtype=th.float16, cache_enabled=False):
+			for _ in range(3):
+				self.model(self.static_input)
+		th.cuda.current_stream(self.device).wait_stream(stream)
+
+		# The autocast cache must be disabled, as the casted weights are created inside the graph #
+		self.cuda_graph = th.cuda.CUDAGraph()
+		with th.cuda.graph(self.cuda_graph), th.no_grad(), th.autocast(device_type='cuda', dtype=th.float16, cache_enabled=False):
+			self.static_output = self.model(self.static_input).float()
+
+	def fast_forward(self, x: th.Tensor):
+		""" Replay the CUDA graph with the input x. The output is the static buffer, overwritten in the next call """
+
+		self.static_input.copy_(x)
+		self.cuda_graph.replay()
+
+		return self.static_output
+
 	def update(self, x: np.ndarray, y: np.ndarray, t: np.ndarray = None):
 		# Update the miopic model
 		self.pre_model.update(x, y)
@@ -46,7 +142,12 @@ class UnetDeepModel:
 			# Stack using the dim 1
 			input_tensor = th.cat((input_tensor_0, input_tensor_1), dim=1)
 			# Predict the model #
-			output_tensor = self.model(input_tensor)
+			if self.cuda_graph is not None:
+				output_tensor = self.fast_forward(input_tensor)
+			else:
+				with th.autocast(device_type=self.device.type, dtype=th.float16, enabled=self.device.type == 'cuda'):
+					output_tensor = self.model(input_tensor)
+				output_tensor = output_tensor.float()
 			# Get the numpy array
 			model_map = output_tensor.squeeze(0).squeeze(0).cpu().detach().numpy() * self.navigation_map
 			model_map[self.pre_model.X[:, 0], self.pre_model.X[:, 1]] = self.pre_model.Y
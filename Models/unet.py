@@ -1,37 +1,65 @@
+import os
+import subprocess
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import numpy as np
 from torchvision.models import vgg16_bn
 
 class DoubleConv(nn.Module):
     """(convolution => LeakyReLU) * 2"""
 
-    def __init__(self, in_channels, out_channels, mid_channels=None):
+    def __init__(self, in_channels, out_channels, mid_channels=None, norm_type='bn'):
         super().__init__()
         if not mid_channels:
             mid_channels = out_channels
         self.double_conv = nn.Sequential(
             nn.Conv2d(in_channels, mid_channels, kernel_size=3, padding=1, bias=False),
-            nn.BatchNorm2d(mid_channels),
+            self.norm_layer(mid_channels, norm_type),
             nn.LeakyReLU(inplace=True),
             nn.Conv2d(mid_channels, out_channels, kernel_size=3, padding=1, bias=False),
-            nn.BatchNorm2d(out_channels),
+            self.norm_layer(out_channels, norm_type),
             nn.LeakyReLU(inplace=True)
         )
 
+    @staticmethod
+    def norm_layer(channels, norm_type):
+        """ BatchNorm ('bn') or GroupNorm ('gn'). GroupNorm does not depend on the batch size, so it behaves the same
+        in training and in the batch 1 inference of the patrolling """
+
+        if norm_type == 'bn':
+            return nn.BatchNorm2d(channels)
+        elif norm_type == 'gn':
+            return nn.GroupNorm(num_groups=min(32, channels), num_channels=channels)
+        else:
+            raise ValueError('Unknown norm type')
+
     def forward(self, x):
 
         return self.double_conv(x)
+
+    def fuse(self):
+        """ Fold every BatchNorm into its preceding convolution (eval mode only).
+        The block becomes (convolution with bias => LeakyReLU) * 2 """
+
+        layers = []
+        for layer in self.double_conv:
+            if isinstance(layer, nn.BatchNorm2d) and layers and isinstance(layers[-1], nn.Conv2d):
+                layers[-1] = fuse_conv_bn_eval(layers[-1], layer)
+            else:
+                layers.append(layer)
+
+        self.double_conv = nn.Sequential(*layers)
     
 class Down(nn.Module):
     """Downscaling with maxpool then double conv"""
 
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, norm_type='bn'):
         super().__init__()
         self.maxpool_conv = nn.Sequential(
             nn.MaxPool2d(2),
-            DoubleConv(in_channels, out_channels)
+            DoubleConv(in_channels, out_channels, norm_type=norm_type)
         )
 
     def forward(self, x):
@@ -39,18 +67,29 @@ class Down(nn.Module):
 
 
 class Up(nn.Module):
-    """Upscaling then double conv"""
+    """Upscaling then double conv. With bilinear=True the upscaling is a sub-pixel convolution (1x1 convolution and
+    PixelShuffle), not a bilinear interpolation. The flag keeps its name for the existing callers, but its checkpoints
+    are not compatible with the ones trained with the former bilinear interpolation"""
 
-    def __init__(self, in_channels, out_channels, bilinear=True):
+    def __init__(self, in_channels, out_channels, bilinear=True, norm_type='bn'):
         super().__init__()
 
-        # if bilinear, use the normal convolutions to reduce the number of channels
+        # if bilinear, the upsampling is a learned sub-pixel convolution that replaces the former bilinear
+        # interpolation: a 1x1 convolution creates the 4 sub-pixels of every channel and the PixelShuffle rearranges
+        # them, which moves less memory. The normal convolutions then reduce the number of channels
         if bilinear:
-            self.up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-            self.conv = DoubleConv(in_channels, out_channels, in_channels // 2)
+            self.up = nn.Sequential(
+                nn.Conv2d(in_channels // 2, in_channels * 2, kernel_size=1, bias=False),
+                nn.PixelShuffle(2)
+            )
+            self.conv = DoubleConv(in_channels, out_channels, in_channels // 2, norm_type=norm_type)
         else:
             self.up = nn.ConvTranspose2d(in_channels, in_channels // 2, kernel_size=2, stride=2)
-            self.conv = DoubleConv(in_channels, out_channels)
+            self.conv = DoubleConv(in_channels, out_channels, norm_type=norm_type)
+
+        # Concatenation buffer reused in eager inference and the shapes it was allocated for
+        self._workspace = None
+        self._workspace_key = None
 
     def forward(self, x1, x2):
         x1 = self.up(x1)
@@ -58,12 +97,42 @@ class Up(nn.Module):
         diffY = x2.size()[2] - x1.size()[2]
         diffX = x2.size()[3] - x1.size()[3] 
 
-        x1 = F.pad(x1, [diffX // 2, diffX - diffX // 2,
-                        diffY // 2, diffY - diffY // 2])
-        # if you have padding issues, see
-        # https://github.com/HaiyongJiang/U-Net-Pytorch-Unstructured-Buggy/commit/0e854509c2cea854e247a9c615f175f76fbb2e3a
-        # https://github.com/xiaopeng-liao/Pytorch-UNet/commit/8ebac70e633bac59fc22bb5195e513d5832fb3bd
-        x = torch.cat([x2, x1], dim=1)
+        # In eager no_grad inference, x2 and x1 are written in the channel slices of a channels_last buffer that is
+        # allocated once and reused while the shapes do not change, and whose padding border stays zeroed.
+        # Everywhere else (autograd, inference_mode, torch.compile, tracing and ONNX export) the pad and the
+        # concatenation are kept, as they are fewer kernels and export as plain Pad and Concat nodes
+        if torch.is_grad_enabled() or torch.is_inference_mode_enabled() or torch.compiler.is_compiling() or \
+                torch.jit.is_tracing() or torch.onnx.is_in_onnx_export():
+            x1 = F.pad(x1, [diffX // 2, diffX - diffX // 2,
+                            diffY // 2, diffY - diffY // 2])
+            # if you have padding issues, see
+            # https://github.com/HaiyongJiang/U-Net-Pytorch-Unstructured-Buggy/commit/0e854509c2cea854e247a9c615f175f76fbb2e3a
+            # https://github.com/xiaopeng-liao/Pytorch-UNet/commit/8ebac70e633bac59fc22bb5195e513d5832fb3bd
+            x = torch.cat([x2, x1], dim=1)
+            # torch.cat may drop the channels_last tag, so restore it for the convolutions
+            x = x.contiguous(memory_format=torch.channels_last)
+
+            return self.conv(x)
+
+        top, left = diffY // 2, diffX // 2
+        bottom, right = top + x1.size()[2], left + x1.size()[3]
+        C2 = x2.size()[1]
+        dtype = torch.promote_types(x1.dtype, x2.dtype)
+
+        key = (x1.size(), x2.size(), dtype, x2.device)
+        if self._workspace_key != key:
+            x = torch.empty((x2.size()[0], C2 + x1.size()[1], x2.size()[2], x2.size()[3]),
+                            dtype=dtype, device=x2.device, memory_format=torch.channels_last)
+            x[:, C2:, :top].zero_()
+            x[:, C2:, bottom:].zero_()
+            x[:, C2:, :, :left].zero_()
+            x[:, C2:, :, right:].zero_()
+            self._workspace, self._workspace_key = x, key
+
+        x = self._workspace
+        x[:, :C2].copy_(x2)
+        x[:, C2:, top:bottom, left:right].copy_(x1)
+
         return self.conv(x)
 
 
@@ -76,27 +145,35 @@ class OutConv(nn.Module):
         return torch.sigmoid(self.conv(x))
     
 class UNet(nn.Module):
-    def __init__(self, n_channels_in, n_channels_out, bilinear=False, scale = 1):
+    """UNet with a sub-pixel convolution (bilinear=True) or a transposed convolution (bilinear=False) in the Up
+    stages. There is no bilinear interpolation, see Up"""
+
+    def __init__(self, n_channels_in, n_channels_out, bilinear=False, scale = 1, norm_type = 'bn'):
 
         super(UNet, self).__init__()
         self.n_channels_in = n_channels_in
         self.n_channels_out = n_channels_out
         self.bilinear = bilinear
         self.scale = scale
+        self.norm_type = norm_type
 
-        self.inc = (DoubleConv(n_channels_in, 64 // self.scale))
-        self.down1 = (Down(64 // self.scale, 128 // self.scale))
-        self.down2 = (Down(128 // self.scale, 256 // self.scale))
-        self.down3 = (Down(256 // self.scale, 512 // self.scale))
+        self.inc = (DoubleConv(n_channels_in, 64 // self.scale, norm_type=norm_type))
+        self.down1 = (Down(64 // self.scale, 128 // self.scale, norm_type))
+        self.down2 = (Down(128 // self.scale, 256 // self.scale, norm_type))
+        self.down3 = (Down(256 // self.scale, 512 // self.scale, norm_type))
         factor = 2 if bilinear else 1
-        self.down4 = (Down(512 // self.scale, 1024 // factor // self.scale))
-        self.up1 = (Up(1024// self.scale, 512 // factor // self.scale, bilinear))
-        self.up2 = (Up(512// self.scale, 256 // factor // self.scale, bilinear))
-        self.up3 = (Up(256// self.scale, 128 // factor// self.scale, bilinear))
-        self.up4 = (Up(128// self.scale, 64 // self.scale, bilinear))
+        self.down4 = (Down(512 // self.scale, 1024 // factor // self.scale, norm_type))
+        self.up1 = (Up(1024// self.scale, 512 // factor // self.scale, bilinear, norm_type))
+        self.up2 = (Up(512// self.scale, 256 // factor // self.scale, bilinear, norm_type))
+        self.up3 = (Up(256// self.scale, 128 // factor// self.scale, bilinear, norm_type))
+        self.up4 = (Up(128// self.scale, 64 // self.scale, bilinear, norm_type))
         self.outc = (OutConv(64 // self.scale, n_channels_out))
 
+        # Store the weights in NHWC so cuDNN can use the Tensor Core kernels without transposing
+        self.to(memory_format=torch.channels_last)
+
     def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
         x1 = self.inc(x)
         x2 = self.down1(x1)
         x3 = self.down2(x2)
@@ -111,16 +188,62 @@ class UNet(nn.Module):
     
     def compute_loss(self, x_gt, x_predicted, mask = None):
 
-        # Compute the loss
+        # Compute the loss in FP32 even under autocast to avoid overflowing the sum reduction
+        x_predicted = x_predicted.float()
+        x_gt = x_gt.float()
 
-        if mask is not None:
-            # Compute the loss only on the masked area
-            loss = F.mse_loss(x_predicted * mask, x_gt * mask, reduction='sum') / mask.sum()
-        else:
-            loss = F.mse_loss(x_predicted, x_gt)
+        with torch.autocast(device_type=x_predicted.device.type, enabled=False):
+
+            if mask is not None:
+                # Compute the loss only on the masked area
+                mask = mask.float()
+                loss = F.mse_loss(x_predicted * mask, x_gt * mask, reduction='sum') / mask.sum()
+            else:
+                loss = F.mse_loss(x_predicted, x_gt)
 
         return loss
 
+    def fuse(self):
+        """ Put the model in eval mode and fold the BatchNorm layers into the convolutions for inference.
+        This freezes the BatchNorm statistics as constants of the convolutions. GroupNorm layers are kept """
+
+        self.eval()
+        for module in list(self.modules()):
+            if isinstance(module, DoubleConv):
+                module.fuse()
+
+        # The fused weights are new tensors, so keep them in NHWC
+        self.to(memory_format=torch.channels_last)
+
+        return self
+
+    def export_trt(self, path, sample_shape, engine_path=None, fp16=True):
+        """ Export the model to ONNX in path and build a TensorRT engine from it with trtexec.
+        The engine is optimized for sample_shape (N x C x H x W). Returns the path of the engine. """
+
+        self.eval()
+        device = next(self.parameters()).device
+
+        torch.onnx.export(self, torch.randn(sample_shape, device=device), path,
+                          opset_version=17,
+                          input_names=['x'],
+                          output_names=['y'],
+                          dynamic_axes={'x': {0: 'N', 2: 'H', 3: 'W'}, 'y': {0: 'N', 2: 'H', 3: 'W'}})
+
+        if engine_path is None:
+            engine_path = os.path.splitext(path)[0] + '.plan'
+
+        # The optimization profile is fixed to the sample shape
+        shape_str = 'x:' + 'x'.join(str(s) for s in sample_shape)
+        command = ['trtexec', '--onnx={}'.format(path), '--saveEngine={}'.format(engine_path),
+                   '--minShapes=' + shape_str, '--optShapes=' + shape_str, '--maxShapes=' + shape_str]
+        if fp16:
+            command.append('--fp16')
+
+        subprocess.run(command, check=True)
+
+        return engine_path
+
 class VAEUnet(nn.Module):
 
     def __init__(self, input_shape, n_channels_in, n_channels_out, bilinear=False, scale = 1):
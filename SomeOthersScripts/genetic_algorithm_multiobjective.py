@@ -1,19 +1,21 @@
 import sys
 sys.path.append('.')
 
-from PathPlanners.NRRA import WanderingAgent
 from deap import algorithms
 from deap import base
 from deap import creator
 from deap import tools
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import deap
 import signal
+import random
 
 import matplotlib.pyplot as plt
 
 import numpy as np
 from Environment.PatrollingEnvironment import DiscreteModelBasedPatrolling
+from Environment.VectorizedPatrollingEnvironment import VectorizedPatrollingEnv
 from deap.algorithms import eaMuPlusLambda
 
 import pickle
@@ -48,85 +50,196 @@ env = DiscreteModelBasedPatrolling(n_agents=N,
 								seed=5000,
                                 random_gt=False)
 
+# Batched copy of the environment to evaluate the whole population at once
+vectorized_env = VectorizedPatrollingEnv.from_env(env)
+
 """ Create a genetic algorithm """
 
 iteration = 0
 seed = 0
 
+# Movement of every action in the map, as the discrete movements of the environment
+angles = 2 * np.pi * np.arange(8) / 8
+action_directions = np.round(np.stack([np.cos(angles), np.sin(angles)], axis=1)).astype(int)
+action_movements = 2 * action_directions
+# Cells crossed by every action (minimove x action x 2), as Vehicle.move checks every one of them
+action_minimoves = np.arange(1, 3)[:, np.newaxis, np.newaxis] * action_directions[np.newaxis]
+
+# Generator of the initial population and the crossover. DEAP varies and mutates with the random module, so it is
+# seeded too and the optimization is reproducible
+rng = np.random.default_rng(seed)
+random.seed(seed)
+
+
+def rollout(vectorized_env, individuals):
+    """ Evaluate all the individuals in a single rollout of vectorized_env, one world per individual """
+
+    # Transform the individuals into a B x T x N array of actions
+    actions = np.asarray(individuals).reshape(len(individuals), -1, N)
+
+    # Run the compiled episodes of all the worlds
+    W, I = vectorized_env.rollout(actions)
+
+    return list(zip(W, I))
+
+# State of every worker of the pool. It is created once by _init_worker and kept for the life of the worker
+_ENV = None
+_SHARED_MEMORY = None
+_POPULATION = None
+
+def _init_worker(worker_env, shared_memory_name, population_shape):
+    """ Store the environment and a view of the shared population in the worker """
+
+    global _ENV, _SHARED_MEMORY, _POPULATION
+
+    init_pool()
+
+    _ENV = worker_env
+    if sys.version_info >= (3, 13):
+        # Only the main process owns the segment, so the worker must not unlink it when it exits
+        _SHARED_MEMORY = shared_memory.SharedMemory(name=shared_memory_name, track=False)
+    else:
+        # The workers share the resource tracker of the main process, where the segment is already registered
+        _SHARED_MEMORY = shared_memory.SharedMemory(name=shared_memory_name)
+    _POPULATION = np.ndarray(population_shape, dtype=np.int8, buffer=_SHARED_MEMORY.buf)
+
+def _evaluate_slice(bounds):
+    """ Evaluate the individuals start:stop of the shared population in the worker """
+
+    start, stop = bounds
+
+    return rollout(_ENV, _POPULATION[start:stop])
+
+def parallel_batched_map(pool, n_processes, population, evaluate, individuals):
+    """ Replacement of map in the toolbox. The individuals are copied to the shared population and every worker
+    receives only the bounds of its slice, which it evaluates with evaluate """
+
+    individuals = list(individuals)
+    population[:len(individuals)] = np.asarray(individuals)
+
+    slices = np.array_split(np.arange(len(individuals)), n_processes)
+    bounds = [(s[0], s[-1] + 1) for s in slices if len(s) > 0]
+
+    fitnesses = pool.map(evaluate, bounds)
+
+    return [fitness for slice_fitnesses in fitnesses for fitness in slice_fitnesses]
 
-# Create a fitness function
-def fitness_function(individual):
+def selNSGA2Vectorized(individuals, k):
+    """ NSGA-II selection as tools.selNSGA2, with the non dominated sort and the crowding distance computed with
+    NumPy broadcasting instead of pairwise Python comparisons """
 
-    # Transform the individual numpy array into a TxN array of actions
-    individual = np.array(individual).reshape(-1,N)
+    # Weighted fitness values, so every objective is maximized
+    fits = np.array([ind.fitness.wvalues for ind in individuals])
 
-    # Reset the environment
+    # dominates[i, j] is True if the individual i dominates the individual j
+    dominates = (fits[:, np.newaxis, :] >= fits[np.newaxis, :, :]).all(-1) & \
+                (fits[:, np.newaxis, :] > fits[np.newaxis, :, :]).any(-1)
 
-    W_mean = []
-    I_mean = []
+    # Peel the fronts. The count of an individual is the number of unranked individuals that dominate it
+    ranks = np.full(len(individuals), -1)
+    domination_count = dominates.sum(axis=0)
+    front = np.where(domination_count == 0)[0]
+    rank = 0
 
-    for _ in range(1):
+    while front.size > 0:
+        ranks[front] = rank
+        domination_count = domination_count - dominates[front].sum(axis=0)
+        front = np.where((domination_count == 0) & (ranks == -1))[0]
+        rank += 1
 
-        env.reset()
+    chosen = []
 
-        # Run the environment
-        W = 0.0
-        I = 0.0
+    for rank in range(ranks.max() + 1):
 
-        for t in range(individual.shape[0]):
-            # Get the actions of the agents at time t
-            actions = {i:individual[t,i] for i in range(N)}
+        front = np.where(ranks == rank)[0]
 
-            # Step the environment
-            _, _, _, info = env.step(actions)
+        if len(chosen) + len(front) <= k:
+            chosen.extend(front)
+            continue
 
-            W += info['W']
-            I += info['I']
+        # Fill the selection with the most isolated individuals of the last front
+        front_fits = fits[front]
+        distances = np.zeros(len(front))
+        for objective in range(fits.shape[1]):
+            order = np.argsort(front_fits[:, objective], kind='stable')
+            sorted_fits = front_fits[order, objective]
+            distances[order[[0, -1]]] = np.inf
+            norm = sorted_fits[-1] - sorted_fits[0]
+            if norm != 0:
+                distances[order[1:-1]] += (sorted_fits[2:] - sorted_fits[:-2]) / norm
 
-        W_mean.append(W.copy())
-        I_mean.append(I.copy())
+        chosen.extend(front[np.argsort(-distances, kind='stable')[:k - len(chosen)]])
+        break
 
-    # Set the seed to an arbitrary value
+    return [individuals[i] for i in chosen]
 
-    return np.mean(W_mean), np.mean(I_mean)
+def same_individual(ind1, ind2):
+    """ Compare two individuals by their raw bytes. Used by the hall of fame when two fitnesses are equal """
+
+    return ind1.tobytes() == ind2.tobytes()
+
+# Scratch buffer of the crossover, reused in every call. The crossover only runs in the main process
+crossover_buffer = np.empty(100 * N, dtype=np.int8)
 
 def cxTwoPointCopy(ind1, ind2):
 
     size = len(ind1)
-    cxpoint1 = np.random.randint(1, size)
-    cxpoint2 = np.random.randint(1, size - 1)
+    cxpoint1 = rng.integers(1, size)
+    cxpoint2 = rng.integers(1, size - 1)
     if cxpoint2 >= cxpoint1:
         cxpoint2 += 1
     else: # Swap the two cx points
         cxpoint1, cxpoint2 = cxpoint2, cxpoint1
 
-    ind1[cxpoint1:cxpoint2], ind2[cxpoint1:cxpoint2] \
-        = ind2[cxpoint1:cxpoint2].copy(), ind1[cxpoint1:cxpoint2].copy()
+    # Swap the segments in place through the scratch buffer
+    length = cxpoint2 - cxpoint1
+    np.copyto(crossover_buffer[:length], ind1[cxpoint1:cxpoint2])
+    np.copyto(ind1[cxpoint1:cxpoint2], ind2[cxpoint1:cxpoint2])
+    np.copyto(ind2[cxpoint1:cxpoint2], crossover_buffer[:length])
 
     return ind1, ind2
 
 def individualCreator():
-    """ Create a random individual with safe movements """
+    """ Create a random individual with safe movements. Every agent keeps its action for 3 consecutive movements
+    unless it collides, and never selects the opposite of its previous action, as the WanderingAgent """
 
-    agents = [WanderingAgent( world = nav_map, movement_length = 2, number_of_actions = 8, consecutive_movements = 3) for _ in range(N)]
     actual_position = initial_positions.copy()
-
-    individual = []
-
-    for _ in range(100):
-        
-        moves = []
-
-        for idx, agent in enumerate(agents):
-            action = agent.move(actual_position[idx])
-            moves.append(action)
-            angle = 2*np.pi * action / 8
-            actual_position[idx] = actual_position[idx] + 2 * np.array([np.cos(angle), np.sin(angle)])
-        
-        individual.append(moves)
-
-
-    individual_deap = creator.Individual(np.array(individual).reshape(-1))
+    actions = np.zeros(N, dtype=int)
+    agents = np.arange(N)
+
+    # The actions 0-8 fit in int8, which makes every copy, pickle and comparison of the individual 8 times smaller
+    individual = np.zeros((100, N), dtype=np.int8)
+
+    for t in range(100):
+
+        # Check the collision of the 8 actions of every agent at once, in the intermediate and the final cell
+        new_positions = actual_position[:, np.newaxis, np.newaxis, :] + action_minimoves[np.newaxis]
+        in_bound = (new_positions[..., 0] >= 0) & (new_positions[..., 0] < nav_map.shape[0]) & \
+                   (new_positions[..., 1] >= 0) & (new_positions[..., 1] < nav_map.shape[1])
+        valid = in_bound & (nav_map[np.clip(new_positions[..., 0], 0, nav_map.shape[0] - 1),
+                                    np.clip(new_positions[..., 1], 0, nav_map.shape[1] - 1)] == 1)
+        valid = valid.all(axis=1)
+
+        # Select a new action when the current one collides or has been repeated 3 times
+        change = np.logical_not(valid[agents, actions]) | (t % 3 == 0)
+
+        if t > 0:
+            # Do not turn back, unless it is the only way out
+            allowed = valid.copy()
+            allowed[agents, (actions + 4) % 8] = False
+            stuck = np.logical_not(allowed.any(axis=1))
+            allowed[stuck] = valid[stuck]
+        else:
+            allowed = valid
+
+        # Sample uniformly one of the allowed actions using random keys
+        keys = np.where(allowed, rng.random((N, 8)), -1.0)
+        actions = np.where(change, np.argmax(keys, axis=1), actions)
+
+        individual[t] = actions
+        actual_position = actual_position + action_movements[actions]
+
+    individual_deap = creator.Individual(individual.reshape(-1))
     
     return individual_deap
 
@@ -143,11 +256,11 @@ toolbox.register("individual", individualCreator)
 # Register the population
 toolbox.register("population", tools.initRepeat, list, toolbox.individual)
 
-# Register the fitness function
-toolbox.register("evaluate", fitness_function)
+# Register the fitness function. It evaluates a slice of the shared population in the workers
+toolbox.register("evaluate", _evaluate_slice)
 
 # Register the selection operator
-toolbox.register("select", tools.selNSGA2)
+toolbox.register("select", selNSGA2Vectorized)
 
 # Register the crossover operator
 toolbox.register("mate", cxTwoPointCopy)
@@ -158,15 +271,6 @@ toolbox.register("mutate", tools.mutUniformInt, low=0, up=8, indpb=0.1)
 
 if __name__ == '__main__':
 
-    """ Create multi-processing pool """
-
-    # Create a pool
-    pool = mp.Pool(processes=8)
-
-    # Register the pool
-    toolbox.register("map", pool.map)
-
-
     # Register the statistics
     stats = tools.Statistics(lambda ind: ind.fitness.values)
 
@@ -175,7 +279,7 @@ if __name__ == '__main__':
     stats.register("min", np.min, axis=0)
 
     # Create a hall of fame
-    hof = tools.ParetoFront(similar=np.array_equal)
+    hof = tools.ParetoFront(similar=same_individual)
 
     # Create a logbook
     logbook = tools.Logbook()
@@ -194,47 +298,63 @@ if __name__ == '__main__':
     # Set the probability of mutation
     mutation_probability = 0.2
 
-    for pb in [[0.8, 0.2], [0.7, 0.3], [0.5, 0.2]]:
+    """ Create multi-processing pool """
 
-        # Run the genetic algorithm
-        population, logbook = eaMuPlusLambda(population=toolbox.population(n=n_individuals),
-                                                toolbox=toolbox,
-                                                mu=n_individuals,
-                                                lambda_=n_individuals,
-                                                cxpb=pb[0],
-                                                mutpb=pb[1],
-                                                ngen=n_generations,
-                                                stats=stats,
-                                                halloffame=hof,
-                                                verbose=True)            
+    # The population to evaluate is shared with the workers as an int8 array
+    n_processes = 8
+    population_shape = (n_individuals, 100 * N)
+    population_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(population_shape)))
+    shared_population = np.ndarray(population_shape, dtype=np.int8, buffer=population_memory.buf)
+
+    # The shared population is released even if the optimization fails
+    pool = None
+    try:
+
+        # Create a pool whose workers keep their own environment
+        pool = mp.Pool(processes=n_processes, initializer=_init_worker,
+                       initargs=(vectorized_env, population_memory.name, population_shape))
+
+        # Register the pool. Every worker evaluates a slice of the population in a batched rollout
+        toolbox.register("map", parallel_batched_map, pool, n_processes, shared_population)
+
+        for pb in [[0.8, 0.2], [0.7, 0.3], [0.5, 0.2]]:
+
+            # Run the genetic algorithm
+            population, logbook = eaMuPlusLambda(population=toolbox.population(n=n_individuals),
+                                                    toolbox=toolbox,
+                                                    mu=n_individuals,
+                                                    lambda_=n_individuals,
+                                                    cxpb=pb[0],
+                                                    mutpb=pb[1],
+                                                    ngen=n_generations,
+                                                    stats=stats,
+                                                    halloffame=hof,
+                                                    verbose=True)            
 
                
 
-    """ Plot the pareto front """
-
-    # Get the pareto front
-    pareto_front = np.array([ind.fitness.values for ind in hof])
-
-    # Plot the pareto front
-    plt.figure()
-    plt.scatter(pareto_front[:,0], pareto_front[:,1])
-    plt.xlabel('W')
-    plt.ylabel('I')
-
-    name = 'pareto_front.png'
-    plt.savefig(f'SomeOthersScripts/' + name)
-
-
-    cp = dict(population=population, generation=100, halloffame=hof, logbook=logbook)
-
-    with open(f"SomeOthersScripts/optimization.pkl", "wb") as cp_file:
-        pickle.dump(cp, cp_file)
-        
-    pool.close()
+        """ Plot the pareto front """
 
+        # Get the pareto front
+        pareto_front = np.array([ind.fitness.values for ind in hof])
 
+        # Plot the pareto front
+        plt.figure()
+        plt.scatter(pareto_front[:,0], pareto_front[:,1])
+        plt.xlabel('W')
+        plt.ylabel('I')
 
+        name = 'pareto_front.png'
+        plt.savefig(f'SomeOthersScripts/' + name)
 
 
+        cp = dict(population=population, generation=100, halloffame=hof, logbook=logbook)
 
+        with open(f"SomeOthersScripts/optimization.pkl", "wb") as cp_file:
+            pickle.dump(cp, cp_file)
 
+    finally:
+        if pool is not None:
+            pool.close()
+        population_memory.close()
+        population_memory.unlink()